@@ -0,0 +1,98 @@
+from bisect import bisect_left
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+
+VERSION_CACHE_KEY = 'tasks:user-directory:version'
+
+# Rebuild at least this often, even if the version never changes. This
+# covers changes no worker is told about: other workers bumping a
+# per-process cache, saves from another process, and queryset
+# update()/bulk_create(), which send no signals.
+MAX_AGE_SECONDS = 60
+
+_lock = threading.Lock()
+# get_version() can return None (e.g. with DummyCache), so "never built"
+# needs its own marker
+_UNBUILT = object()
+# (version, built at, sorted normalized usernames, matching (key, id, username)
+# rows), swapped as a whole so readers never see a half-built directory
+_snapshot = (_UNBUILT, 0, [], [])
+_timer = time.monotonic
+
+
+def normalize_username(username):
+    return username.casefold()
+
+
+def _fresh_version():
+    # Seed from the clock so a lost key never resurrects a version that a
+    # worker already has cached
+    return time.time_ns()
+
+
+def get_version():
+    """
+    Current directory version. It lives in the Django cache so that saves in
+    one worker invalidate the copy held by every other worker.
+    """
+    version = cache.get(VERSION_CACHE_KEY)
+    if version is None:
+        # add() is a no-op if another worker initialised the key first
+        cache.add(VERSION_CACHE_KEY, _fresh_version(), timeout=None)
+        version = cache.get(VERSION_CACHE_KEY)
+    return version
+
+
+def invalidate():
+    try:
+        cache.incr(VERSION_CACHE_KEY)
+    except ValueError:
+        # Key missing or evicted, start a fresh version sequence
+        cache.set(VERSION_CACHE_KEY, _fresh_version(), timeout=None)
+
+
+def _build():
+    rows = User.objects.values_list('id', 'username')
+    entries = sorted(
+        (normalize_username(username), user_id, username)
+        for user_id, username in rows
+    )
+    keys = [entry[0] for entry in entries]
+    return keys, entries
+
+
+def _is_current(snapshot, version, now):
+    return snapshot[0] == version and now - snapshot[1] < MAX_AGE_SECONDS
+
+
+def _load():
+    global _snapshot
+    version = get_version()
+    snapshot = _snapshot
+    if not _is_current(snapshot, version, _timer()):
+        with _lock:
+            snapshot = _snapshot
+            now = _timer()
+            if not _is_current(snapshot, version, now):
+                snapshot = (version, now, *_build())
+                _snapshot = snapshot
+    return snapshot[2], snapshot[3]
+
+
+def search(prefix, limit=10):
+    """
+    Return up to `limit` `{id, username}` dicts whose username starts with
+    `prefix`, ignoring case, ordered by normalized username.
+    """
+    keys, entries = _load()
+    prefix = normalize_username(prefix)
+    results = []
+    for index in range(bisect_left(keys, prefix), len(keys)):
+        if len(results) >= limit or not keys[index].startswith(prefix):
+            break
+        _, user_id, username = entries[index]
+        results.append({'id': user_id, 'username': username})
+    return results
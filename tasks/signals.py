@@ -1,6 +1,9 @@
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
+from django.db import transaction
+from django.contrib.auth.models import User
 from .models import Task, ActivityLog
+from . import directory
 
 @receiver(pre_save, sender=Task)
 def update_activity_log(sender, instance, **kwargs):
@@ -19,4 +22,19 @@ def update_activity_log(sender, instance, **kwargs):
                     previous_due_date=old_task.due_date
                 )
         except Task.DoesNotExist:
-            pass 
\ No newline at end of file
+            pass
+
+# Queryset update() and bulk_create() send no signals, so usernames changed
+# that way only show up once the directory reaches directory.MAX_AGE_SECONDS
+@receiver(post_save, sender=User)
+def invalidate_user_directory(sender, instance, created, update_fields=None, **kwargs):
+    # Logins only touch last_login, which the directory doesn't hold
+    if update_fields is not None and 'username' not in update_fields:
+        return
+    # Bump only once the row is visible, or another worker could rebuild
+    # without it and keep that copy under the new version
+    transaction.on_commit(directory.invalidate)
+
+@receiver(post_delete, sender=User)
+def invalidate_user_directory_on_delete(sender, instance, **kwargs):
+    transaction.on_commit(directory.invalidate)
@@ -0,0 +1,328 @@
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth.models import User, update_last_login
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from . import directory, throttling
+from .models import Project, Task
+from .throttling import ActionRateThrottle, ConcurrencyLimitMixin, record_rejection
+from .views import TaskViewSet
+
+
+class BatchRetrieveTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_user('admin', password='pw', is_staff=True)
+        self.contributor = User.objects.create_user('bob', password='pw')
+        self.project = Project.objects.create(title='Board', description='', owner=self.admin)
+        self.own_task = self.make_task('own', assigned_to=self.contributor)
+        self.other_task = self.make_task('other', assigned_to=self.admin)
+        self.deleted_task = self.make_task('deleted', assigned_to=self.contributor, is_deleted=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.contributor)
+
+    def make_task(self, title, **kwargs):
+        return Task.objects.create(
+            title=title, description='', due_date=timezone.now(), project=self.project, **kwargs
+        )
+
+    def test_returns_markers_per_id_in_requested_order(self):
+        ids = [self.other_task.id, self.own_task.id, self.deleted_task.id, 999, self.own_task.id]
+        response = self.client.get('/api/tasks/batch/', {'ids': ','.join(map(str, ids))})
+
+        self.assertEqual(response.status_code, 200)
+        results = response.json()['results']
+        self.assertEqual(results[0], {'id': self.other_task.id, 'error': 'forbidden'})
+        self.assertEqual(results[1]['id'], self.own_task.id)
+        self.assertEqual(results[1]['project_title'], 'Board')
+        self.assertEqual(results[2], {'id': self.deleted_task.id, 'error': 'not_found'})
+        self.assertEqual(results[3], {'id': 999, 'error': 'not_found'})
+        # Duplicates are dropped
+        self.assertEqual(len(results), 4)
+
+    def test_admin_sees_every_task(self):
+        self.client.force_authenticate(self.admin)
+        ids = f'{self.own_task.id},{self.other_task.id}'
+        results = self.client.get('/api/tasks/batch/', {'ids': ids}).json()['results']
+
+        self.assertEqual([result['id'] for result in results], [self.own_task.id, self.other_task.id])
+        self.assertNotIn('error', results[0])
+        self.assertNotIn('error', results[1])
+
+    def test_loads_visible_tasks_in_one_query(self):
+        self.client.force_authenticate(self.admin)
+        tasks = [self.make_task(f'extra {index}', assigned_to=self.contributor) for index in range(5)]
+        ids = ','.join(str(task.id) for task in [self.own_task, self.other_task, *tasks])
+
+        # Serializing project_title must not add a query per task
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/tasks/batch/', {'ids': ids})
+        self.assertEqual(len(response.json()['results']), 7)
+
+    def test_missing_ids_cost_one_extra_query(self):
+        ids = f'{self.own_task.id},{self.other_task.id},{self.deleted_task.id},999'
+
+        with self.assertNumQueries(2):
+            response = self.client.get('/api/tasks/batch/', {'ids': ids})
+        self.assertEqual(len(response.json()['results']), 4)
+
+    def test_projects_batch(self):
+        response = self.client.get('/api/projects/batch/', {'ids': f'{self.project.id},77'})
+
+        results = response.json()['results']
+        self.assertEqual(results[0]['title'], 'Board')
+        self.assertEqual(results[1], {'id': 77, 'error': 'not_found'})
+
+    def test_rejects_too_many_ids(self):
+        ids = ','.join(str(pk) for pk in range(1, 52))
+        response = self.client.get('/api/tasks/batch/', {'ids': ids})
+        self.assertEqual(response.status_code, 400)
+
+        ids = ','.join(str(pk) for pk in range(1, 51))
+        response = self.client.get('/api/tasks/batch/', {'ids': ids})
+        self.assertEqual(response.status_code, 200)
+
+    def test_rejects_bad_or_empty_ids(self):
+        for ids in ['1,abc', '', ',,']:
+            response = self.client.get('/api/tasks/batch/', {'ids': ids})
+            self.assertEqual(response.status_code, 400, ids)
+
+        response = self.client.get('/api/tasks/batch/')
+        self.assertEqual(response.status_code, 400)
+
+
+class UserSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        directory._snapshot = (directory._UNBUILT, 0, [], [])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.admin = User.objects.create_user('Admin', password='pw', is_staff=True)
+            for username in ['alice', 'Alan', 'bob', 'alfred', 'zed']:
+                User.objects.create_user(username)
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def search(self, **params):
+        response = self.client.get('/api/users/', params)
+        self.assertEqual(response.status_code, 200)
+        return [user['username'] for user in response.json()['results']]
+
+    def test_prefix_search_ignores_case(self):
+        self.assertEqual(self.search(q='al'), ['Alan', 'alfred', 'alice'])
+        self.assertEqual(self.search(q='AL'), ['Alan', 'alfred', 'alice'])
+        self.assertEqual(self.search(q='a'), ['Admin', 'Alan', 'alfred', 'alice'])
+        self.assertEqual(self.search(q='x'), [])
+
+    def test_results_are_id_and_username(self):
+        response = self.client.get('/api/users/', {'q': 'bob'})
+        bob = User.objects.get(username='bob')
+        self.assertEqual(response.json()['results'], [{'id': bob.id, 'username': 'bob'}])
+
+    def test_limit_is_clamped(self):
+        self.assertEqual(self.search(q='al', limit=2), ['Alan', 'alfred'])
+        self.assertEqual(self.search(q='al', limit=0), ['Alan'])
+        with self.captureOnCommitCallbacks(execute=True):
+            for index in range(60):
+                User.objects.create_user(f'user{index:02d}')
+        self.assertEqual(len(self.search(q='user', limit=500)), 50)
+
+        response = self.client.get('/api/users/', {'q': 'al', 'limit': 'many'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_without_q_lists_users(self):
+        response = self.client.get('/api/users/')
+        self.assertEqual(response.json()['count'], 6)
+
+    def test_requires_admin(self):
+        self.client.force_authenticate(User.objects.get(username='bob'))
+        response = self.client.get('/api/users/', {'q': 'al'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_warm_search_does_not_query(self):
+        self.search(q='al')
+        with self.assertNumQueries(0):
+            self.search(q='al')
+
+    def test_save_invalidates_after_commit(self):
+        self.search(q='al')
+        zed = User.objects.get(username='zed')
+        zed.username = 'Alz'
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            zed.save()
+            # Still the old directory until the transaction commits
+            self.assertEqual(self.search(q='al'), ['Alan', 'alfred', 'alice'])
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(self.search(q='al'), ['Alan', 'alfred', 'alice', 'Alz'])
+
+    def test_delete_invalidates(self):
+        self.search(q='al')
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.get(username='alice').delete()
+        self.assertEqual(self.search(q='al'), ['Alan', 'alfred'])
+
+    def test_rebuilds_after_max_age(self):
+        now = [1000.0]
+        with mock.patch.object(directory, '_timer', lambda: now[0]):
+            self.search(q='al')
+            # Queryset updates send no signal, so the version stays the same
+            User.objects.filter(username='zed').update(username='Alz')
+
+            now[0] += directory.MAX_AGE_SECONDS - 1
+            self.assertEqual(self.search(q='al'), ['Alan', 'alfred', 'alice'])
+
+            now[0] += 1
+            self.assertEqual(self.search(q='al'), ['Alan', 'alfred', 'alice', 'Alz'])
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+    def test_works_without_a_cache(self):
+        self.assertIsNone(directory.get_version())
+        # Keep max age out of the way: the first search must build anyway
+        with mock.patch.object(directory, '_timer', lambda: 0.0):
+            self.assertEqual(self.search(q='al'), ['Alan', 'alfred', 'alice'])
+
+    def test_last_login_save_keeps_directory(self):
+        version = directory.get_version()
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            update_last_login(None, User.objects.get(username='bob'))
+        self.assertEqual(callbacks, [])
+        self.assertEqual(directory.get_version(), version)
+
+
+@mock.patch.object(TaskViewSet, 'action_throttle_rates', {
+    'update_status': {'user': '2/min', 'endpoint': '3/min'},
+})
+class ThrottlingTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        ActionRateThrottle._buckets.clear()
+        ConcurrencyLimitMixin._limiters.clear()
+        self.now = 1000.0
+        timer = mock.patch.object(ActionRateThrottle, 'timer', side_effect=lambda: self.now)
+        timer.start()
+        self.addCleanup(timer.stop)
+        self.admin = User.objects.create_user('admin', password='pw', is_staff=True)
+        self.bob = User.objects.create_user('bob', password='pw')
+        self.carol = User.objects.create_user('carol', password='pw')
+        project = Project.objects.create(title='Board', description='', owner=self.admin)
+        self.bob_task = Task.objects.create(
+            title='bob', description='', due_date=timezone.now(), project=project, assigned_to=self.bob
+        )
+        self.carol_task = Task.objects.create(
+            title='carol', description='', due_date=timezone.now(), project=project, assigned_to=self.carol
+        )
+        self.client = APIClient()
+
+    def update_status(self, user, task):
+        self.client.force_authenticate(user)
+        # update_status prints debugging output on every call
+        with redirect_stdout(StringIO()):
+            return self.client.patch(f'/api/tasks/{task.id}/update_status/', {'status': 'DONE'}, format='json')
+
+    def throttle_stats(self):
+        self.client.force_authenticate(self.admin)
+        return self.client.get('/api/tasks/throttle_stats/').json()
+
+    def test_user_bucket_rejects_with_retry_after_and_refills(self):
+        self.assertEqual(self.update_status(self.bob, self.bob_task).status_code, 200)
+        self.assertEqual(self.update_status(self.bob, self.bob_task).status_code, 200)
+
+        response = self.update_status(self.bob, self.bob_task)
+        self.assertEqual(response.status_code, 429)
+        # 2/min refills one token every 30 seconds
+        self.assertEqual(response['Retry-After'], '30')
+
+        self.now += 30
+        self.assertEqual(self.update_status(self.bob, self.bob_task).status_code, 200)
+        self.assertEqual(self.update_status(self.bob, self.bob_task).status_code, 429)
+
+    def test_rejected_user_does_not_drain_endpoint_bucket(self):
+        for _ in range(10):
+            self.update_status(self.bob, self.bob_task)
+
+        # bob only took 2 of the 3 endpoint tokens
+        self.assertEqual(self.update_status(self.carol, self.carol_task).status_code, 200)
+        response = self.update_status(self.carol, self.carol_task)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '20')
+
+        # The endpoint rejection handed carol's user token back
+        self.now += 20
+        self.assertEqual(self.update_status(self.carol, self.carol_task).status_code, 200)
+
+    def test_rejections_are_counted(self):
+        for _ in range(4):
+            self.update_status(self.bob, self.bob_task)
+        self.update_status(self.carol, self.carol_task)
+        self.update_status(self.carol, self.carol_task)
+
+        stats = self.throttle_stats()
+        self.assertEqual(stats['update_status'], {'user': 2, 'endpoint': 1, 'concurrency': 0})
+        self.assertEqual(stats['create'], {'user': 0, 'endpoint': 0, 'concurrency': 0})
+
+    def test_rejection_logging_is_sampled(self):
+        with mock.patch.object(throttling, 'REJECTION_LOG_EVERY', 3):
+            with self.assertLogs('tasks.throttling', 'WARNING') as logs:
+                for _ in range(7):
+                    record_rejection('update_status', 'user')
+
+        self.assertEqual(len(logs.records), 3)
+        self.assertIn('6 so far', logs.output[-1])
+        self.assertEqual(self.throttle_stats()['update_status']['user'], 7)
+
+    @mock.patch.object(ActionRateThrottle, 'max_buckets', 3)
+    def test_least_recently_used_bucket_is_evicted(self):
+        throttle = ActionRateThrottle()
+        first = throttle.get_bucket(('first',), '2/min', 0)
+        second = throttle.get_bucket(('second',), '2/min', 0)
+        throttle.get_bucket(('third',), '2/min', 0)
+        throttle.get_bucket(('first',), '2/min', 0)
+        throttle.get_bucket(('fourth',), '2/min', 0)
+
+        # 'second' was used least recently, 'first' was touched again
+        self.assertEqual(len(ActionRateThrottle._buckets), 3)
+        self.assertIs(throttle.get_bucket(('first',), '2/min', 0), first)
+        self.assertIsNot(throttle.get_bucket(('second',), '2/min', 0), second)
+
+        for index in range(10):
+            throttle.get_bucket((index,), '2/min', 0)
+        self.assertEqual(len(ActionRateThrottle._buckets), 3)
+
+    def test_throttle_stats_requires_admin(self):
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(self.client.get('/api/tasks/throttle_stats/').status_code, 403)
+
+    def test_sheds_load_when_too_many_writes_in_flight(self):
+        limiter = TaskViewSet().get_concurrency_limiter()
+        limiter.in_flight = TaskViewSet.concurrency_limit
+
+        response = self.update_status(self.bob, self.bob_task)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(self.throttle_stats()['update_status']['concurrency'], 1)
+
+        limiter.in_flight = 0
+        self.assertEqual(self.update_status(self.bob, self.bob_task).status_code, 200)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_reads_are_not_limited(self):
+        limiter = TaskViewSet().get_concurrency_limiter()
+        limiter.in_flight = TaskViewSet.concurrency_limit
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(self.client.get('/api/tasks/').status_code, 200)
+
+    def test_slot_is_released_when_handler_raises(self):
+        self.client.force_authenticate(self.admin)
+        data = {'title': 't', 'description': 'd', 'due_date': timezone.now().isoformat(), 'project': self.bob_task.project_id}
+
+        with mock.patch.object(TaskViewSet, 'perform_create', side_effect=RuntimeError('db down')):
+            for _ in range(TaskViewSet.concurrency_limit + 1):
+                with self.assertRaises(RuntimeError):
+                    self.client.post('/api/tasks/', data, format='json')
+
+        self.assertEqual(TaskViewSet().get_concurrency_limiter().in_flight, 0)
+        self.assertEqual(self.client.post('/api/tasks/', data, format='json').status_code, 201)
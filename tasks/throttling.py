@@ -0,0 +1,226 @@
+from collections import OrderedDict
+import threading
+import time
+import logging
+
+from django.core.cache import cache
+from rest_framework import exceptions, status
+from rest_framework.throttling import BaseThrottle
+
+logger = logging.getLogger(__name__)
+
+REJECTION_REASONS = ('user', 'endpoint', 'concurrency')
+# Log the first rejection of each kind and then every Nth, the counter has the rest
+REJECTION_LOG_EVERY = 100
+
+
+def _rejection_key(action, reason):
+    return f'throttle:rejected:{action}:{reason}'
+
+
+def record_rejection(action, reason):
+    key = _rejection_key(action, reason)
+    # add() is a no-op when the counter already exists
+    cache.add(key, 0, timeout=None)
+    try:
+        count = cache.incr(key)
+    except ValueError:
+        count = 1
+        cache.set(key, count, timeout=None)
+    if count == 1 or count % REJECTION_LOG_EVERY == 0:
+        logger.warning(f"Rejected {action} request ({reason} limit), {count} so far")
+
+
+def get_rejection_counts(actions):
+    """
+    Rejected request counters for `actions`, as `{action: {reason: count}}`.
+    They live in the Django cache, so with the default per-process cache each
+    worker only reports its own rejections, and the cache may cull them.
+    """
+    return {
+        action: {
+            reason: cache.get(_rejection_key(action, reason), 0)
+            for reason in REJECTION_REASONS
+        }
+        for action in actions
+    }
+
+
+class ServiceUnavailable(exceptions.APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many requests in progress, please retry shortly.'
+    default_code = 'service_unavailable'
+
+    def __init__(self, detail=None, code=None, wait=None):
+        super().__init__(detail, code)
+        # Picked up by DRF's exception handler as the Retry-After header
+        self.wait = wait
+
+
+class TokenBucket:
+    """
+    Holds up to `capacity` tokens and refills `refill_per_second` of them.
+    """
+    def __init__(self, capacity, refill_per_second, now):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated_at = now
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(0, now - self.updated_at)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_per_second)
+        self.updated_at = now
+
+    def take(self, now):
+        """
+        Take a token. Returns 0 on success, otherwise the seconds until one
+        is available.
+        """
+        with self._lock:
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.refill_per_second
+
+    def give_back(self):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class ActionRateThrottle(BaseThrottle):
+    """
+    Token buckets per action, configured by the view's `action_throttle_rates`,
+    e.g. `{'update_status': {'user': '30/min', 'endpoint': '600/min'}}`.
+    `'30/min'` is both the bucket size and how fast it refills. The 'user'
+    bucket is per requesting user and is checked first, so a client that is
+    already over its own limit never drains the 'endpoint' bucket shared by
+    everyone. Actions without rates are not limited.
+
+    Buckets live in this worker process, so every worker enforces the rates
+    on its own.
+    """
+    scopes = ('user', 'endpoint')
+    timer = time.monotonic
+    # Past this many buckets, the least recently used one is dropped
+    max_buckets = 10000
+
+    _buckets = OrderedDict()
+    _buckets_lock = threading.Lock()
+
+    def parse_rate(self, rate):
+        num, period = rate.split('/')
+        duration = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[period[0]]
+        return int(num), duration
+
+    def get_bucket_key(self, scope, request, view):
+        if scope == 'endpoint':
+            return (view.basename, view.action, scope)
+        if request.user and request.user.is_authenticated:
+            ident = request.user.pk
+        else:
+            ident = self.get_ident(request)
+        return (view.basename, view.action, scope, ident)
+
+    def get_bucket(self, key, rate, now):
+        # The rate is part of the key so a config change starts a new bucket
+        key = key + (rate,)
+        with self._buckets_lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                self._buckets.move_to_end(key)
+                return bucket
+            while len(self._buckets) >= self.max_buckets:
+                self._buckets.popitem(last=False)
+            capacity, duration = self.parse_rate(rate)
+            bucket = self._buckets[key] = TokenBucket(capacity, capacity / duration, now)
+            return bucket
+
+    def allow_request(self, request, view):
+        rates = getattr(view, 'action_throttle_rates', {}).get(view.action, {})
+        now = self.timer()
+        taken = []
+        for scope in self.scopes:
+            rate = rates.get(scope)
+            if rate is None:
+                continue
+            bucket = self.get_bucket(self.get_bucket_key(scope, request, view), rate, now)
+            wait = bucket.take(now)
+            if wait:
+                # The request is rejected, so it shouldn't cost the earlier buckets anything
+                for earlier in taken:
+                    earlier.give_back()
+                self.wait_seconds = wait
+                record_rejection(view.action, scope)
+                return False
+            taken.append(bucket)
+        return True
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class ConcurrencyLimiter:
+    """
+    Counts requests in flight in this process and refuses new ones past `limit`.
+    A worker that serves one request at a time (gunicorn's default sync
+    worker) never gets past 1, so the limit only matters with threaded workers.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+class ConcurrencyLimitMixin:
+    """
+    Sheds load with a 503 and Retry-After once `concurrency_limit` requests
+    for `concurrency_limited_actions` are already running in this process.
+    Size the limit per worker, below its thread count.
+    """
+    concurrency_limit = None
+    concurrency_limited_actions = ()
+    concurrency_retry_after = 1
+
+    _limiters = {}
+    _limiters_lock = threading.Lock()
+
+    def get_concurrency_limiter(self):
+        key = type(self)
+        with self._limiters_lock:
+            if key not in self._limiters:
+                self._limiters[key] = ConcurrencyLimiter(self.concurrency_limit)
+            return self._limiters[key]
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if self.concurrency_limit and self.action in self.concurrency_limited_actions:
+            limiter = self.get_concurrency_limiter()
+            if not limiter.acquire():
+                record_rejection(self.action, 'concurrency')
+                raise ServiceUnavailable(wait=self.concurrency_retry_after)
+            self._concurrency_limiter = limiter
+
+    def dispatch(self, request, *args, **kwargs):
+        # Release in finally: dispatch re-raises errors DRF doesn't handle
+        # without reaching finalize_response, which would leak the slot
+        self._concurrency_limiter = None
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            if self._concurrency_limiter is not None:
+                self._concurrency_limiter.release()
+                self._concurrency_limiter = None
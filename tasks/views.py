@@ -6,6 +6,8 @@ from datetime import timedelta
 from .models import Project, Task, ActivityLog
 from .serializers import ProjectSerializer, TaskSerializer, ActivityLogSerializer
 from .permissions import IsAdminOrReadOnly, IsAssignedContributor
+from .throttling import ConcurrencyLimitMixin, ActionRateThrottle, get_rejection_counts
+from . import directory
 from django.contrib.auth.models import User
 from rest_framework import serializers, permissions
 from rest_framework_simplejwt.views import TokenObtainPairView
@@ -16,7 +18,54 @@ import logging
 # Add logging for debugging
 logger = logging.getLogger(__name__)
 
-class ProjectViewSet(viewsets.ModelViewSet):
+class BatchRetrieveMixin:
+    """
+    Adds a `GET /<resource>/batch/?ids=1,2,3` action that loads several
+    objects with a single query. Objects outside `get_queryset()` are
+    reported per id instead of failing the whole batch.
+    """
+    batch_max_ids = 50
+    batch_select_related = ()
+
+    @action(detail=False, methods=['get'])
+    def batch(self, request):
+        raw_ids = request.query_params.get('ids', '')
+        try:
+            ids = [int(value) for value in raw_ids.split(',') if value.strip()]
+        except ValueError:
+            return Response({'detail': 'ids must be a comma-separated list of integers.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Keep the requested order but drop duplicates
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return Response({'detail': 'At least one id is required.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(ids) > self.batch_max_ids:
+            return Response({'detail': f'At most {self.batch_max_ids} ids can be requested at once.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        queryset = self.get_queryset()
+        # select_related() with no fields would join every foreign key
+        if self.batch_select_related:
+            queryset = queryset.select_related(*self.batch_select_related)
+        visible = queryset.in_bulk(ids)
+
+        # Only pay for the existence check when something was filtered out
+        missing = [pk for pk in ids if pk not in visible]
+        existing = set()
+        if missing:
+            existing = set(self.queryset.filter(pk__in=missing).values_list('pk', flat=True))
+
+        results = []
+        for pk in ids:
+            if pk in visible:
+                results.append(self.get_serializer(visible[pk]).data)
+            elif pk in existing:
+                results.append({'id': pk, 'error': 'forbidden'})
+            else:
+                results.append({'id': pk, 'error': 'not_found'})
+
+        return Response({'results': results}, status=status.HTTP_200_OK)
+
+class ProjectViewSet(BatchRetrieveMixin, viewsets.ModelViewSet):
     queryset = Project.objects.filter(is_deleted=False)
     serializer_class = ProjectSerializer
     permission_classes = [IsAdminOrReadOnly]
@@ -28,12 +77,24 @@ class ProjectViewSet(viewsets.ModelViewSet):
         instance.is_deleted = True
         instance.save()
 
-class TaskViewSet(viewsets.ModelViewSet):
+class TaskViewSet(ConcurrencyLimitMixin, BatchRetrieveMixin, viewsets.ModelViewSet):
     queryset = Task.objects.filter(is_deleted=False)
     serializer_class = TaskSerializer
+    batch_select_related = ('project',)
+
+    # Token buckets per action: 'user' is per requesting user, 'endpoint' is shared
+    throttle_classes = [ActionRateThrottle]
+    action_throttle_rates = {
+        'update_status': {'user': '30/min', 'endpoint': '600/min'},
+        'partial_update': {'user': '30/min', 'endpoint': '600/min'},
+    }
+    # Writes allowed to run at once in one worker before we answer 503. Only
+    # takes effect with threaded workers (gunicorn --threads above this)
+    concurrency_limit = 4
+    concurrency_limited_actions = ('create', 'update', 'partial_update', 'update_status', 'destroy')
     
     def get_permissions(self):
-        if self.action in ['list', 'retrieve']:
+        if self.action in ['list', 'retrieve', 'batch']:
             return [permissions.IsAuthenticated()]
         if self.action in ['partial_update', 'update_status']:
             # Allow contributors to PATCH their own tasks, admins can PATCH any task
@@ -235,6 +296,16 @@ class TaskViewSet(viewsets.ModelViewSet):
             'all_tasks': TaskSerializer(all_tasks, many=True).data
         })
 
+    @action(detail=False, methods=['get'])
+    def throttle_stats(self, request):
+        """
+        Number of requests rejected by throttling or load shedding, per action.
+        """
+        if not request.user.is_staff:
+            return Response({'detail': 'Only admins can view throttle stats.'}, status=status.HTTP_403_FORBIDDEN)
+        actions = set(self.action_throttle_rates) | set(self.concurrency_limited_actions)
+        return Response(get_rejection_counts(sorted(actions)), status=status.HTTP_200_OK)
+
     @action(detail=False, methods=['get'], permission_classes=[permissions.IsAuthenticated])
     def test(self, request):
         """
@@ -274,6 +345,21 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [permissions.IsAdminUser]
+    search_max_results = 50
+
+    def list(self, request, *args, **kwargs):
+        query = request.query_params.get('q')
+        if query is None:
+            return super().list(request, *args, **kwargs)
+
+        # Prefix search for the assignee picker, served from the cached directory
+        try:
+            limit = int(request.query_params.get('limit', 10))
+        except ValueError:
+            return Response({'detail': 'limit must be an integer.'}, status=status.HTTP_400_BAD_REQUEST)
+        limit = max(1, min(limit, self.search_max_results))
+
+        return Response({'results': directory.search(query.strip(), limit=limit)}, status=status.HTTP_200_OK)
 
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])